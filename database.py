@@ -5,16 +5,21 @@ MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import ConnectionFailure, PyMongoError
+import redis.asyncio as redis
 from datetime import datetime, timezone
 import os
+import logging
 from dotenv import load_dotenv
-from typing import Union
+from typing import Optional, Union
 from pydantic import BaseModel
 
 # Load environment variables from .env file
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 _client = None
 db = None
 
@@ -22,12 +27,34 @@ database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
 if database_url and database_name:
-    _client = MongoClient(database_url)
+    # One client per process; pool sizes are per worker
+    _client = AsyncIOMotorClient(
+        database_url,
+        maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", 100)),
+        minPoolSize=int(os.getenv("MONGO_MIN_POOL_SIZE", 10)),
+        serverSelectionTimeoutMS=int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 2000)),
+        compressors="zstd,zlib",
+        tz_aware=True,
+        tzinfo=timezone.utc,
+    )
     db = _client[database_name]
 
+# Optional Redis cache for read-heavy endpoints; caching is skipped when REDIS_URL is unset
+cache = None
+
+redis_url = os.getenv("REDIS_URL")
+
+if redis_url:
+    cache = redis.from_url(redis_url)
+
 # Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
-    """Insert a single document with timestamp"""
+def utc_now() -> datetime:
+    """Current UTC time truncated to the millisecond precision BSON dates store"""
+    now = datetime.now(timezone.utc)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+async def create_document(collection_name: str, data: Union[BaseModel, dict], now: Optional[datetime] = None):
+    """Insert a single document with timestamp and return it (including its _id)"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
 
@@ -37,13 +64,16 @@ def create_document(collection_name: str, data: Union[BaseModel, dict]):
     else:
         data_dict = data.copy()
 
-    data_dict['created_at'] = datetime.now(timezone.utc)
-    data_dict['updated_at'] = datetime.now(timezone.utc)
+    # Callers pass `now` when the same timestamp is also embedded elsewhere in the document
+    now = now or utc_now()
+    data_dict['created_at'] = now
+    data_dict['updated_at'] = now
 
-    result = db[collection_name].insert_one(data_dict)
-    return str(result.inserted_id)
+    result = await db[collection_name].insert_one(data_dict)
+    data_dict['_id'] = result.inserted_id
+    return data_dict
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
+async def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
     """Get documents from collection"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -52,4 +82,26 @@ def get_documents(collection_name: str, filter_dict: dict = None, limit: int = N
     if limit:
         cursor = cursor.limit(limit)
     
-    return list(cursor)
+    return await cursor.to_list(length=None)
+
+async def ensure_indexes():
+    """Create the indexes used by the API's queries (no-op if they already exist)"""
+    if db is None:
+        return
+
+    # Failures are logged, not raised: the API should still start when Mongo is down
+    # or existing data violates an index (e.g. duplicate emails from before it existed)
+    indexes = [
+        ("user", "email", {"unique": True}),
+        ("order", [("user_id", 1), ("created_at", -1)], {}),
+        ("order", [("status", 1), ("created_at", -1)], {}),
+        ("order", "created_at", {}),
+    ]
+    for collection_name, keys, options in indexes:
+        try:
+            await db[collection_name].create_index(keys, **options)
+        except ConnectionFailure:
+            logger.warning("Skipping index creation, database unreachable", exc_info=True)
+            return
+        except PyMongoError:
+            logger.warning("Could not create index %s on %s", keys, collection_name, exc_info=True)
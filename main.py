@@ -1,17 +1,29 @@
 import os
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, Response
+from fastapi.security import HTTPBasic, HTTPBasicCredentials, HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field
 from typing import List, Optional
 from bson.objectid import ObjectId
-from datetime import datetime
-from database import db, create_document, get_documents
-from schemas import User as UserSchema, Menuitem as MenuItemSchema, Order as OrderSchema, OrderItem as OrderItemSchema
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from datetime import datetime, timezone
+from database import db, cache, create_document, get_documents, ensure_indexes, utc_now
+from schemas import User as UserSchema, Order as OrderSchema, OrderItem as OrderItemSchema
 import hashlib
-import base64
-
-app = FastAPI(title="Li-Fi Smart Canteen API")
+import hmac
+import secrets
+import time
+import jwt
+import orjson
+import logging
+from redis.exceptions import RedisError
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+
+app = FastAPI(title="Li-Fi Smart Canteen API", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -23,18 +35,86 @@ app.add_middleware(
 
 security = HTTPBasic()
 
+logger = logging.getLogger(__name__)
+
+
+@app.on_event("startup")
+async def startup():
+    await ensure_indexes()
+
+
 # Utilities
 
+password_hasher = PasswordHasher()
+_sha256 = hashlib.sha256
+
+
 def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+    return password_hasher.hash(password)
+
+
+def is_legacy_hash(password_hash: str) -> bool:
+    # accounts created before argon2 store an unsalted sha256 hex digest
+    return not password_hash.startswith("$argon2")
+
+
+def verify_password(password_hash: str, password: str) -> bool:
+    if is_legacy_hash(password_hash):
+        return hmac.compare_digest(password_hash, _sha256(password.encode()).hexdigest())
+    try:
+        return password_hasher.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+
+def password_needs_rehash(password_hash: str) -> bool:
+    return is_legacy_hash(password_hash) or password_hasher.check_needs_rehash(password_hash)
+
+
+# The cache is optional: Redis errors are treated as a miss / skipped write, never as a request failure
+async def cache_get(key: str):
+    if cache is None:
+        return None
+    try:
+        return await cache.get(key)
+    except RedisError:
+        logger.warning("cache get failed for %s", key, exc_info=True)
+        return None
+
+
+async def cache_set(key: str, value: bytes, ttl: int):
+    if cache is None:
+        return
+    try:
+        await cache.set(key, value, ex=ttl)
+    except RedisError:
+        logger.warning("cache set failed for %s", key, exc_info=True)
+
+
+async def cache_incr(key: str):
+    if cache is None:
+        return
+    try:
+        await cache.incr(key)
+    except RedisError:
+        logger.warning("cache incr failed for %s", key, exc_info=True)
+
+
+def json_bytes_response(body: bytes) -> Response:
+    return Response(content=body, media_type="application/json")
+
+
+def parse_object_id(value: str, not_found: str) -> ObjectId:
+    # reject malformed ids up front instead of letting ObjectId() raise a 500
+    if not ObjectId.is_valid(value):
+        raise HTTPException(status_code=404, detail=not_found)
+    return ObjectId(value)
 
 
 def obj_id_str(doc):
     if doc is None:
         return doc
-    doc["id"] = str(doc.get("_id"))
-    if "_id" in doc:
-        del doc["_id"]
+    doc["id"] = str(doc.pop("_id", None))
     return doc
 
 
@@ -49,85 +129,137 @@ class LoginRequest(BaseModel):
     email: str
     password: str
 
-class LoginResponse(BaseModel):
-    token: str
-    user: dict
-
 
 @app.get("/")
-def root():
+async def root():
     return {"message": "Li-Fi Smart Canteen API running"}
 
 
-# Basic token storage (DB-based tokens could be added; for simplicity generate stateless token)
+# Stateless signed tokens (JWT); set JWT_SECRET so tokens survive restarts and are shared across workers
+JWT_SECRET = os.getenv("JWT_SECRET")
+if not JWT_SECRET:
+    logger.warning(
+        "JWT_SECRET is not set; using a random per-process key. Tokens will not survive a restart "
+        "or --reload and will only be accepted by the worker that issued them."
+    )
+    JWT_SECRET = secrets.token_urlsafe(32)
+JWT_ALGORITHM = "HS256"
+TOKEN_TTL_SECONDS = 24 * 60 * 60
+
+bearer = HTTPBearer()
+
 
 def make_token(email: str) -> str:
-    raw = f"{email}:{datetime.utcnow().timestamp()}"
-    return base64.urlsafe_b64encode(hashlib.sha256(raw.encode()).digest()).decode()
+    now = int(time.time())
+    return jwt.encode({"sub": email, "iat": now, "exp": now + TOKEN_TTL_SECONDS}, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+
+def current_user_email(credentials: HTTPAuthorizationCredentials = Depends(bearer)) -> str:
+    try:
+        claims = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    return claims["sub"]
 
 
 @app.post("/api/auth/signup")
-def signup(payload: SignupRequest):
-    existing = db["user"].find_one({"email": payload.email})
+async def signup(payload: SignupRequest):
+    existing = await db["user"].find_one({"email": payload.email}, {"_id": 1})
     if existing:
         raise HTTPException(status_code=400, detail="Email already registered")
     user = UserSchema(
         name=payload.name,
         email=payload.email,
-        password_hash=hash_password(payload.password),
+        password_hash=await run_in_threadpool(hash_password, payload.password),
         is_admin=payload.is_admin,
     )
-    uid = create_document("user", user)
-    created = db["user"].find_one({"_id": ObjectId(uid)})
-    return obj_id_str(created)
+    try:
+        created = await create_document("user", user)
+    except DuplicateKeyError:
+        # a concurrent signup with the same email won the unique index race
+        raise HTTPException(status_code=400, detail="Email already registered")
+    created.pop("password_hash", None)
+    return ORJSONResponse(obj_id_str(created))
 
 
-@app.post("/api/auth/login", response_model=LoginResponse)
-def login(payload: LoginRequest):
-    user = db["user"].find_one({"email": payload.email})
-    if not user or user.get("password_hash") != hash_password(payload.password):
+@app.post("/api/auth/login")
+async def login(payload: LoginRequest):
+    user = await db["user"].find_one({"email": payload.email}, {"name": 1, "email": 1, "password_hash": 1, "is_admin": 1})
+    stored_hash = user.pop("password_hash", None) if user else None
+    # argon2 is deliberately CPU-heavy, so keep it off the event loop
+    if not stored_hash or not await run_in_threadpool(verify_password, stored_hash, payload.password):
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    if password_needs_rehash(stored_hash):
+        new_hash = await run_in_threadpool(hash_password, payload.password)
+        await db["user"].update_one({"_id": user["_id"]}, {"$set": {"password_hash": new_hash}})
     token = make_token(user["email"])
-    return LoginResponse(token=token, user=obj_id_str(user))
+    return ORJSONResponse({"token": token, "user": obj_id_str(user)})
+
+
+@app.get("/api/auth/me")
+async def me(email: str = Depends(current_user_email)):
+    user = await db["user"].find_one({"email": email}, {"name": 1, "email": 1, "is_admin": 1})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return ORJSONResponse(obj_id_str(user))
 
 
 # Menu CRUD
+# Writers bump the generation instead of deleting the cached list, so a slow reader that
+# filled the cache from pre-write data stores it under a key nobody reads any more
+MENU_CACHE_KEY = "menu:v1"
+MENU_GENERATION_KEY = "menu:v1:generation"
+MENU_CACHE_TTL = 60
+
+
 class MenuCreate(BaseModel):
     title: str
     description: Optional[str] = None
-    price: float
+    price: float = Field(..., ge=0)  # keep in sync with schemas.Menuitem.price
     image_url: Optional[str] = None
     available: bool = True
 
 
 @app.get("/api/menu")
-def list_menu():
-    items = list(db["menuitem"].find())
-    return [obj_id_str(i) for i in items]
+async def list_menu():
+    generation = await cache_get(MENU_GENERATION_KEY) or b"0"
+    cache_key = f"{MENU_CACHE_KEY}:{generation.decode()}"
+    cached = await cache_get(cache_key)
+    if cached is not None:
+        return json_bytes_response(cached)
+    items = await db["menuitem"].find().to_list(length=None)
+    body = orjson.dumps([obj_id_str(i) for i in items])
+    await cache_set(cache_key, body, MENU_CACHE_TTL)
+    return json_bytes_response(body)
 
 
 @app.post("/api/menu")
-def create_menu_item(payload: MenuCreate):
-    item = MenuItemSchema(**payload.model_dump())
-    mid = create_document("menuitem", item)
-    created = db["menuitem"].find_one({"_id": ObjectId(mid)})
-    return obj_id_str(created)
+async def create_menu_item(payload: MenuCreate):
+    # MenuCreate carries the same fields and constraints as Menuitem, so store it as-is
+    created = await create_document("menuitem", payload)
+    await cache_incr(MENU_GENERATION_KEY)
+    return ORJSONResponse(obj_id_str(created))
 
 
 @app.put("/api/menu/{item_id}")
-def update_menu_item(item_id: str, payload: MenuCreate):
-    res = db["menuitem"].update_one({"_id": ObjectId(item_id)}, {"$set": payload.model_dump() | {"updated_at": datetime.utcnow()}})
-    if res.matched_count == 0:
+async def update_menu_item(item_id: str, payload: MenuCreate):
+    updated = await db["menuitem"].find_one_and_update(
+        {"_id": parse_object_id(item_id, "Item not found")},
+        {"$set": payload.model_dump() | {"updated_at": datetime.now(timezone.utc)}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if updated is None:
         raise HTTPException(status_code=404, detail="Item not found")
-    updated = db["menuitem"].find_one({"_id": ObjectId(item_id)})
-    return obj_id_str(updated)
+    await cache_incr(MENU_GENERATION_KEY)
+    return ORJSONResponse(obj_id_str(updated))
 
 
 @app.delete("/api/menu/{item_id}")
-def delete_menu_item(item_id: str):
-    res = db["menuitem"].delete_one({"_id": ObjectId(item_id)})
+async def delete_menu_item(item_id: str):
+    res = await db["menuitem"].delete_one({"_id": parse_object_id(item_id, "Item not found")})
     if res.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Item not found")
+    await cache_incr(MENU_GENERATION_KEY)
     return {"success": True}
 
 
@@ -138,32 +270,51 @@ class CreateOrderRequest(BaseModel):
     payment_method: str
 
 
+ORDERS_PAGE_SIZE = 50
+ORDERS_MAX_PAGE_SIZE = 200
+
+
+async def fetch_orders_page(query: dict, skip: int, limit: int) -> dict:
+    """Newest-first page of orders; next_skip is None once the last page is reached"""
+    cursor = db["order"].find(query).sort("created_at", -1).skip(skip).limit(limit).batch_size(limit)
+    items = [obj_id_str(i) for i in await cursor.to_list(length=limit)]
+    next_skip = skip + limit if len(items) == limit else None
+    return {"items": items, "next_skip": next_skip}
+
+
 @app.post("/api/orders")
-def create_order(payload: CreateOrderRequest):
+async def create_order(payload: CreateOrderRequest):
     # compute totals
-    total = sum([it.qty * it.price for it in payload.items])
+    total = sum((it.qty * it.price for it in payload.items), 0.0)
     eta = max(10, 5 * len(payload.items))
-    # generate QR content
-    qr_content = f"ORDER|{payload.user_id}|{datetime.utcnow().isoformat()}|{total}"
-    order = OrderSchema(
+    # generate QR content; it carries the same timestamp that is stored as created_at
+    now = utc_now()
+    qr_content = f"ORDER|{payload.user_id}|{now.isoformat()}|{total}"
+    # payload is already validated, so skip re-validating it as an Order
+    order = OrderSchema.model_construct(
         user_id=payload.user_id,
-        items=[OrderItemSchema(**i.model_dump()) for i in payload.items],
+        items=payload.items,
         total=total,
         payment_method=payload.payment_method,
         status="Pending",
         eta_minutes=eta,
         qr_code=qr_content,
     )
-    oid = create_document("order", order)
-    created = db["order"].find_one({"_id": ObjectId(oid)})
-    return obj_id_str(created)
+    created = await create_document("order", order, now=now)
+    return ORJSONResponse(obj_id_str(created))
 
 
 @app.get("/api/orders")
-def list_orders(status: Optional[str] = None):
+async def list_orders(
+    status: Optional[str] = None,
+    limit: int = Query(ORDERS_PAGE_SIZE, ge=1, le=ORDERS_MAX_PAGE_SIZE),
+    skip: int = Query(0, ge=0),
+):
     query = {"status": status} if status else {}
-    items = list(db["order"].find(query).sort("created_at", -1))
-    return [obj_id_str(i) for i in items]
+    return ORJSONResponse(await fetch_orders_page(query, skip, limit))
+
+
+ORDER_STATUSES = frozenset({"Pending", "Preparing", "Ready", "Completed"})
 
 
 class UpdateOrderStatus(BaseModel):
@@ -171,42 +322,63 @@ class UpdateOrderStatus(BaseModel):
 
 
 @app.put("/api/orders/{order_id}/status")
-def update_order_status(order_id: str, payload: UpdateOrderStatus):
-    if payload.status not in ["Pending", "Preparing", "Ready", "Completed"]:
+async def update_order_status(order_id: str, payload: UpdateOrderStatus):
+    if payload.status not in ORDER_STATUSES:
         raise HTTPException(status_code=400, detail="Invalid status")
-    res = db["order"].update_one({"_id": ObjectId(order_id)}, {"$set": {"status": payload.status, "updated_at": datetime.utcnow()}})
-    if res.matched_count == 0:
+    updated = await db["order"].find_one_and_update(
+        {"_id": parse_object_id(order_id, "Order not found")},
+        {"$set": {"status": payload.status, "updated_at": datetime.now(timezone.utc)}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if updated is None:
         raise HTTPException(status_code=404, detail="Order not found")
-    updated = db["order"].find_one({"_id": ObjectId(order_id)})
-    return obj_id_str(updated)
+    return ORJSONResponse(obj_id_str(updated))
 
 
 @app.get("/api/orders/user/{user_id}")
-def orders_by_user(user_id: str):
-    items = list(db["order"].find({"user_id": user_id}).sort("created_at", -1))
-    return [obj_id_str(i) for i in items]
+async def orders_by_user(
+    user_id: str,
+    limit: int = Query(ORDERS_PAGE_SIZE, ge=1, le=ORDERS_MAX_PAGE_SIZE),
+    skip: int = Query(0, ge=0),
+):
+    return ORJSONResponse(await fetch_orders_page({"user_id": user_id}, skip, limit))
 
 
 # Analytics
+ANALYTICS_CACHE_TTL = 30
+
+
 @app.get("/api/analytics/daily")
-def analytics_daily():
-    today = datetime.utcnow().date()
-    start = datetime(today.year, today.month, today.day)
+async def analytics_daily():
+    today = datetime.now(timezone.utc).date()
+    cache_key = f"analytics:daily:{today.isoformat()}"
+    cached = await cache_get(cache_key)
+    if cached is not None:
+        return json_bytes_response(cached)
+    start = datetime(today.year, today.month, today.day, tzinfo=timezone.utc)
+    # totals and most ordered items share a single scan of today's orders
     pipeline = [
         {"$match": {"created_at": {"$gte": start}}},
-        {"$group": {"_id": None, "total_sales": {"$sum": "$total"}, "orders": {"$sum": 1}}},
-    ]
-    result = list(db["order"].aggregate(pipeline))
-    data = result[0] if result else {"total_sales": 0, "orders": 0}
-    # most ordered items
-    pipeline_items = [
-        {"$unwind": "$items"},
-        {"$group": {"_id": "$items.title", "count": {"$sum": "$items.qty"}}},
-        {"$sort": {"count": -1}},
-        {"$limit": 5},
+        {"$project": {"_id": 0, "total": 1, "items.title": 1, "items.qty": 1}},
+        {"$facet": {
+            "totals": [
+                {"$group": {"_id": None, "total_sales": {"$sum": "$total"}, "orders": {"$sum": 1}}},
+            ],
+            "top_items": [
+                {"$unwind": "$items"},
+                {"$group": {"_id": "$items.title", "count": {"$sum": "$items.qty"}}},
+                {"$sort": {"count": -1}},
+                {"$limit": 5},
+            ],
+        }},
     ]
-    top_items = list(db["order"].aggregate(pipeline_items))
-    return {"total_sales": data.get("total_sales", 0), "orders": data.get("orders", 0), "top_items": top_items}
+    result = await db["order"].aggregate(pipeline).to_list(length=1)
+    facets = result[0] if result else {"totals": [], "top_items": []}
+    data = facets["totals"][0] if facets["totals"] else {"total_sales": 0, "orders": 0}
+    top_items = facets["top_items"]
+    body = orjson.dumps({"total_sales": data.get("total_sales", 0), "orders": data.get("orders", 0), "top_items": top_items})
+    await cache_set(cache_key, body, ANALYTICS_CACHE_TTL)
+    return json_bytes_response(body)
 
 
 # Simulated Li-Fi endpoint
@@ -216,26 +388,41 @@ class LiFiPayload(BaseModel):
 
 
 @app.post("/api/lifi/send")
-def lifi_send(data: LiFiPayload):
+async def lifi_send(data: LiFiPayload):
     # In a real Li-Fi, this would transfer via light; here we simulate with a state change and echo back
-    order = db["order"].find_one({"_id": ObjectId(data.order_id)})
-    if not order:
-        raise HTTPException(status_code=404, detail="Order not found")
     # mark as preparing as a side-effect to simulate acknowledgement
-    db["order"].update_one({"_id": ObjectId(data.order_id)}, {"$set": {"status": "Preparing", "updated_at": datetime.utcnow()}})
+    res = await db["order"].update_one(
+        {"_id": parse_object_id(data.order_id, "Order not found")},
+        {"$set": {"status": "Preparing", "updated_at": datetime.now(timezone.utc)}},
+    )
+    if res.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Order not found")
     return {"status": "ACK", "received": True, "order_id": data.order_id, "effect": "Order moved to Preparing"}
 
 
-# Schema inspector for the built-in DB viewer
-@app.get("/schema")
-def get_schema_defs():
+# Schema inspector for the built-in DB viewer; the schemas are static, so build the response once
+def _build_schema_defs() -> bytes:
     from inspect import getmembers, isclass
     import schemas as s
-    models = {name: cls.model_json_schema() for name, cls in getmembers(s) if isclass(cls) and hasattr(cls, 'model_json_schema')}
-    return models
+    # only models defined in schemas.py; the imported BaseModel itself can't produce a schema
+    models = {name: cls.model_json_schema() for name, cls in getmembers(s) if isclass(cls) and issubclass(cls, BaseModel) and cls.__module__ == s.__name__}
+    return orjson.dumps(models)
+
+
+_SCHEMA_DEFS = _build_schema_defs()
+
+
+@app.get("/schema")
+async def get_schema_defs():
+    return json_bytes_response(_SCHEMA_DEFS)
 
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # without a shared JWT_SECRET every worker signs with its own random key, so stay on one worker
+    default_workers = (os.cpu_count() or 1) if os.getenv("JWT_SECRET") else 1
+    workers = int(os.getenv("WEB_CONCURRENCY", default_workers))
+    if workers > 1 and not os.getenv("JWT_SECRET"):
+        raise SystemExit("JWT_SECRET must be set to run with more than one worker")
+    uvicorn.run("main:app", host="0.0.0.0", port=port, workers=workers, loop="uvloop", http="httptools")